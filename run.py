@@ -1,11 +1,13 @@
 import streamlit as st
 import duckdb
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import numpy as np
 from datetime import datetime, timedelta
 import os
+import queue
+import shutil
 import tempfile
+from contextlib import contextmanager
 
 # Set page config
 st.set_page_config(
@@ -18,150 +20,294 @@ st.set_page_config(
 st.title("❄️ Iceberg Metadata Insights")
 st.markdown("Key insights into your Iceberg tables' metadata and snapshots.")
 
+# In-memory DuckDB database by default; set DUCKDB_DATABASE to opt into a
+# database file (only one process can hold its write lock at a time)
+DUCKDB_DATABASE = os.environ.get("DUCKDB_DATABASE", ":memory:")
+DUCKDB_EXTENSIONS = ["aws", "httpfs", "iceberg", "parquet"]
+
 # Initialize DuckDB with required extensions
 @st.cache_resource
 def initialize_duckdb():
-    conn = duckdb.connect(database=':memory:')
-
-    # Install and load required extensions
-    conn.execute("INSTALL aws;")
-    conn.execute("LOAD aws;")
-    conn.execute("INSTALL httpfs;")
-    conn.execute("LOAD httpfs;")
-    conn.execute("INSTALL iceberg;")
-    conn.execute("LOAD iceberg;")
-    conn.execute("INSTALL parquet;")
-    conn.execute("LOAD parquet;")
+    conn = duckdb.connect(database=DUCKDB_DATABASE, read_only=False)
+
+    # Install missing extensions only on first bootstrap, then load them.
+    # Installed extensions live in the global extension directory, so this
+    # check works for in-memory databases too
+    installed = {
+        row[0] for row in conn.execute(
+            "SELECT extension_name FROM duckdb_extensions() WHERE installed"
+        ).fetchall()
+    }
+    for extension in DUCKDB_EXTENSIONS:
+        if extension not in installed:
+            conn.execute(f"INSTALL {extension};")
+        conn.execute(f"LOAD {extension};")
+
+    # Keep decoded Parquet metadata and HTTP connections around between queries
+    conn.execute("SET GLOBAL enable_object_cache=true;")
+    conn.execute("SET GLOBAL http_keep_alive=true;")
+
+    # Optionally cap DuckDB memory usage (e.g. DUCKDB_MEMORY_LIMIT=4GB)
+    memory_limit = os.environ.get("DUCKDB_MEMORY_LIMIT")
+    if memory_limit:
+        conn.execute(f"SET GLOBAL memory_limit='{memory_limit}';")
 
     # Load AWS credentials
     conn.execute("CALL load_aws_credentials();")
 
     return conn
 
-# Get DuckDB connection
-conn = initialize_duckdb()
+# Pool of connections to the shared database so concurrent sessions don't
+# serialize on a single connection, override the size with DUCKDB_POOL_SIZE
+DUCKDB_POOL_SIZE = int(os.environ.get("DUCKDB_POOL_SIZE", 4))
+
+@st.cache_resource
+def get_pool(size=DUCKDB_POOL_SIZE):
+    conn = initialize_duckdb()
+    pool = queue.Queue()
+    for _ in range(size):
+        # Cursors are separate connections to the same database, sharing its
+        # loaded extensions, settings and object cache
+        pool.put(conn.cursor())
+    return pool
+
+@contextmanager
+def checkout(pool):
+    """Borrow a connection from the pool for the duration of the block"""
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+# Get DuckDB connection pool
+pool = get_pool()
+
+def discard_upload():
+    """Delete this session's saved upload, if any"""
+    upload = st.session_state.pop("upload", None)
+    if upload is not None:
+        try:
+            os.unlink(upload["path"])
+        except OSError:
+            pass
 
 # Sidebar for input options
 st.sidebar.header("Iceberg Table Source")
 input_option = st.sidebar.radio("Select input method:", ["Upload Metadata File", "S3 Path", "Local Path"])
 
 metadata_path = None
+source_key = None
+uploaded_file = None
 
 if input_option == "Upload Metadata File":
     uploaded_file = st.sidebar.file_uploader("Choose an Iceberg metadata JSON file", type=["json"])
     if uploaded_file is not None:
-        # Save uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.json') as temp_file:
-            temp_file.write(uploaded_file.getvalue())
-            metadata_path = temp_file.name
+        # Write each upload to disk once per session, so reruns (e.g. widget
+        # interactions) reuse the same file instead of copying it again
+        upload = st.session_state.get("upload")
+        if upload is None or upload["file_id"] != uploaded_file.file_id:
+            discard_upload()
+
+            # Stream uploaded file to a temporary file in 1 MiB chunks
+            uploaded_file.seek(0)
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.json') as temp_file:
+                shutil.copyfileobj(uploaded_file, temp_file, length=1 << 20)
+            upload = {"file_id": uploaded_file.file_id, "path": temp_file.name}
+            st.session_state["upload"] = upload
+
+        metadata_path = upload["path"]
+        source_key = upload["file_id"]
         st.sidebar.success(f"File uploaded successfully!")
 elif input_option == "S3 Path":
     default_s3_path = "s3://<BUCKET>/warehouse/sales/metadata/00001-cae4181c-e8ec-4d6a-97b6-c4732cc9c434.metadata.json"
     metadata_path = st.sidebar.text_input("Enter S3 path to metadata file:", value=default_s3_path)
+    source_key = metadata_path
 else:
     default_local_path = "data/iceberg/lineitem_iceberg"
     metadata_path = st.sidebar.text_input("Enter local path to Iceberg table:", value=default_local_path)
+    source_key = metadata_path
+
+# Remove the saved upload once it is cleared or another input method is chosen
+if uploaded_file is None:
+    discard_upload()
 
 # Add button to analyze
 analyze_button = st.sidebar.button("Analyze Table")
 
+# Remember the analyzed source so widget reruns keep showing its analysis
+if analyze_button:
+    st.session_state["analyzed_source"] = source_key
+
 # Add link to documentation
 st.sidebar.markdown("---")
 st.sidebar.markdown("[DuckDB Iceberg Documentation](https://duckdb.org/docs/stable/extensions/iceberg/overview.html)")
 
+# Cached metadata loaders - keyed on the source (the path, or the file_id for
+# uploads, whose temporary path changes every rerun) so reruns and other
+# sessions reuse the decoded results instead of re-reading the manifests.
+# The underscore-prefixed path argument is not hashed by Streamlit.
+# Exceptions are not cached, so a failed read is retried on the next run.
+# Results stay in Arrow and are converted to pandas only where displayed.
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def load_snapshots(source_key, _metadata_path):
+    """Load the snapshot history of an Iceberg table, oldest first"""
+    with checkout(pool) as conn:
+        return (
+            conn.table_function('iceberg_snapshots', [_metadata_path])
+            .project('*, timestamp_ms AS timestamp')
+            .order('timestamp_ms')
+            .to_arrow_table()
+        )
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def load_key_metrics(source_key, _metadata_path):
+    """Compute the write/delete/manifest key metrics in one DuckDB pass"""
+    with checkout(pool) as conn:
+        # Composed as relations, DuckDB optimizes and runs it as a single plan
+        snapshots = conn.table_function('iceberg_snapshots', [_metadata_path]).set_alias('s')
+        manifests = (
+            conn.table_function('iceberg_metadata', [_metadata_path])
+            .project('manifest_sequence_number, status, record_count')  # Only the columns the metrics need
+            .set_alias('m')
+        )
+        operations = snapshots.join(
+            manifests, 's.sequence_number = m.manifest_sequence_number', how='left'
+        ).aggregate("""
+            s.snapshot_id,
+            SUM(CASE WHEN m.status = 'ADDED' THEN m.record_count ELSE 0 END) AS added_records,
+            SUM(CASE WHEN m.status = 'DELETED' THEN m.record_count ELSE 0 END) AS deleted_records,
+            COUNT(m.manifest_sequence_number) AS manifest_count
+        """, 's.snapshot_id')
+
+        return operations.aggregate("""
+            COUNT(*) AS snapshot_count,
+            COUNT(*) FILTER (WHERE added_records > 0) AS write_ops,
+            COUNT(*) FILTER (WHERE deleted_records > 0) AS delete_ops,
+            AVG(manifest_count) AS avg_manifests
+        """).to_arrow_table()
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def load_schema(source_key, _metadata_path):
+    """Load the current schema of an Iceberg table"""
+    with checkout(pool) as conn:
+        return conn.table_function('iceberg_schema', [_metadata_path]).to_arrow_table()
+
 # Helper functions for insights
-def extract_operation_metrics(snapshots_df, manifest_df):
-    """Extract metrics about operations (add/delete)"""
-    if manifest_df.empty or snapshots_df.empty:
-        return pd.DataFrame()
-
-    operations = []
-
-    for idx, snapshot in snapshots_df.iterrows():
-        seq_num = snapshot['sequence_number']
-        snapshot_manifests = manifest_df[manifest_df['manifest_sequence_number'] == seq_num]
-
-        if 'status' in snapshot_manifests.columns:
-            adds = snapshot_manifests[snapshot_manifests['status'] == 'ADDED']['record_count'].sum()
-            deletes = snapshot_manifests[snapshot_manifests['status'] == 'DELETED']['record_count'].sum()
-
-            operations.append({
-                'snapshot_id': snapshot['snapshot_id'],
-                'timestamp': snapshot['timestamp'] if 'timestamp' in snapshot else pd.NaT,
-                'sequence_number': seq_num,
-                'added_records': adds,
-                'deleted_records': deletes,
-                'net_change': adds - deletes,
-                'manifest_count': len(snapshot_manifests)
-            })
-
-    return pd.DataFrame(operations)
-
-def calculate_snapshot_intervals(snapshots_df):
-    """Calculate time intervals between snapshots"""
-    if 'timestamp' not in snapshots_df.columns or len(snapshots_df) <= 1:
-        return pd.DataFrame()
-
-    sorted_df = snapshots_df.sort_values('timestamp').reset_index(drop=True)
-    intervals = []
-
-    for i in range(1, len(sorted_df)):
-        prev = sorted_df.iloc[i-1]
-        curr = sorted_df.iloc[i]
-
-        time_diff = (curr['timestamp'] - prev['timestamp']).total_seconds()
-        hours_diff = time_diff / 3600
-        days_diff = time_diff / (3600 * 24)
-
-        intervals.append({
-            'previous_snapshot': prev['snapshot_id'],
-            'current_snapshot': curr['snapshot_id'],
-            'previous_time': prev['timestamp'],
-            'current_time': curr['timestamp'],
-            'interval_seconds': time_diff,
-            'interval_hours': hours_diff,
-            'interval_days': days_diff
-        })
-
-    return pd.DataFrame(intervals)
+def calculate_snapshot_intervals(snapshots_tbl):
+    """Calculate time intervals between consecutive snapshots in the loaded table"""
+    with checkout(pool) as conn:
+        # Window over the in-memory Arrow snapshots, not another metadata read
+        return conn.from_arrow(snapshots_tbl).query("snapshots", """
+            WITH intervals AS (
+                SELECT
+                    LAG(snapshot_id) OVER w AS previous_snapshot,
+                    snapshot_id AS current_snapshot,
+                    LAG(timestamp) OVER w AS previous_time,
+                    timestamp AS current_time,
+                    (epoch_ms(timestamp) - epoch_ms(LAG(timestamp) OVER w)) / 1000.0 AS interval_seconds
+                FROM snapshots
+                WINDOW w AS (ORDER BY timestamp)
+            )
+            SELECT
+                *,
+                interval_seconds / 3600 AS interval_hours,
+                interval_seconds / (3600 * 24) AS interval_days
+            FROM intervals
+            WHERE previous_snapshot IS NOT NULL
+            ORDER BY current_time
+        """).to_arrow_table()
+
+# Plotly is imported lazily so reruns that draw no charts don't pay for it
+def build_timeline_figure(snapshots_df):
+    """Build the snapshot timeline figure"""
+    import plotly.graph_objects as go
+
+    # Draw markers and connecting line as a single WebGL trace
+    timestamps = snapshots_df['timestamp'].to_numpy()
+    fig = go.Figure(
+        go.Scattergl(
+            x=timestamps,
+            y=np.ones(len(timestamps), dtype=np.int8),  # All points on same level
+            mode='lines+markers',
+            marker=dict(size=10, color='blue'),
+            line=dict(color='lightblue', width=1),
+            customdata=snapshots_df['snapshot_id'].to_numpy(),
+            hovertemplate="<b>Snapshot ID:</b> %{customdata}<br><b>Time:</b> %{x}<extra></extra>",
+            showlegend=False
+        )
+    )
+
+    # Improve layout
+    fig.update_layout(
+        title="Snapshot Timeline",
+        height=300,
+        yaxis=dict(
+            showticklabels=False,
+            showgrid=False,
+            zeroline=False,
+            range=[0.5, 1.5]  # Fix y-axis range
+        ),
+        xaxis=dict(
+            title="Time"
+        ),
+        hovermode="x unified",
+        margin=dict(l=20, r=20, t=40, b=20),
+    )
+
+    return fig
+
+def build_interval_histogram(interval_hours):
+    """Build the snapshot interval histogram figure"""
+    import plotly.graph_objects as go
+
+    # Bin the intervals up front with numpy
+    counts, edges = np.histogram(interval_hours, bins=min(10, len(interval_hours)))
+    fig = go.Figure(
+        go.Bar(
+            x=(edges[:-1] + edges[1:]) / 2,
+            y=counts,
+            width=np.diff(edges) * 0.9,  # Leave a 10% gap between bars
+            marker_color='lightblue',
+            hovertemplate="<b>Interval (hours):</b> %{x:.1f}<br><b>Count:</b> %{y}<extra></extra>"
+        )
+    )
+
+    fig.update_layout(
+        title="Distribution of Snapshot Intervals",
+        xaxis_title="Hours between snapshots",
+        yaxis_title="Count",
+        height=300
+    )
+
+    return fig
 
 # Main content
-if metadata_path and analyze_button:
+if metadata_path and source_key == st.session_state.get("analyzed_source"):
     try:
         # Get snapshot data
         try:
-            snapshots_df = conn.execute(f"""
-                SELECT * FROM iceberg_snapshots('{metadata_path}')
-            """).fetchdf()
-
-            # Convert timestamp to datetime if it's not already
-            if not snapshots_df.empty and 'timestamp_ms' in snapshots_df.columns:
-                snapshots_df['timestamp'] = pd.to_datetime(snapshots_df['timestamp_ms'])
+            snapshots_tbl = load_snapshots(source_key, metadata_path)
+            snapshots_df = snapshots_tbl.to_pandas()
         except Exception as e:
             st.error(f"Error fetching snapshots: {str(e)}")
+            snapshots_tbl = None
             snapshots_df = pd.DataFrame()
 
-        # Get manifest data
+        # Get key operation metrics as a single row
         try:
-            manifest_df = conn.execute(f"""
-                SELECT * FROM iceberg_metadata('{metadata_path}')
-            """).fetchdf()
+            key_metrics = load_key_metrics(source_key, metadata_path).to_pylist()[0]
+            if not key_metrics['snapshot_count']:
+                key_metrics = None
         except Exception as e:
             st.error(f"Error fetching metadata: {str(e)}")
-            manifest_df = pd.DataFrame()
+            key_metrics = None
 
         # Get schema information
         try:
-            schema_df = conn.execute(f"""
-                SELECT * FROM iceberg_schema('{metadata_path}')
-            """).fetchdf()
+            schema_tbl = load_schema(source_key, metadata_path)
         except Exception as e:
-            schema_df = pd.DataFrame()
-
-        # Calculate insights
-        if not snapshots_df.empty and not manifest_df.empty:
-            operations_df = extract_operation_metrics(snapshots_df, manifest_df)
-            intervals_df = calculate_snapshot_intervals(snapshots_df)
+            schema_tbl = None
 
         # Key Metrics Section - Only the requested metrics
         st.header("Key Metrics")
@@ -171,121 +317,67 @@ if metadata_path and analyze_button:
             st.metric("Total Snapshots", len(snapshots_df) if not snapshots_df.empty else 0)
 
         with metric_cols[1]:
-            if not operations_df.empty:
-                write_ops = operations_df[operations_df['added_records'] > 0].shape[0]
-                st.metric("Write Operations", write_ops)
+            if key_metrics:
+                st.metric("Write Operations", key_metrics['write_ops'])
             else:
                 st.metric("Write Operations", "N/A")
 
         with metric_cols[2]:
-            if not operations_df.empty:
-                delete_ops = operations_df[operations_df['deleted_records'] > 0].shape[0]
-                st.metric("Delete Operations", delete_ops)
+            if key_metrics:
+                st.metric("Delete Operations", key_metrics['delete_ops'])
             else:
                 st.metric("Delete Operations", "N/A")
 
         with metric_cols[3]:
-            if not operations_df.empty:
-                avg_manifests = operations_df['manifest_count'].mean()
-                st.metric("Avg Manifests/Snapshot", f"{avg_manifests:.1f}")
+            if key_metrics:
+                st.metric("Avg Manifests/Snapshot", f"{key_metrics['avg_manifests']:.1f}")
             else:
                 st.metric("Avg Manifests/Snapshot", "N/A")
 
         # Snapshots Timeline Section - Simplified
         st.header("Snapshots Timeline")
-        if not snapshots_df.empty and 'timestamp' in snapshots_df.columns and len(snapshots_df) > 1:
-            # Create simple timeline visualization
-            fig = px.scatter(
-                snapshots_df.sort_values('timestamp'),
-                x='timestamp',
-                y=[1] * len(snapshots_df),  # All points on same level
-                size=[10] * len(snapshots_df),  # Same size for all points
-                color_discrete_sequence=['blue'],
-                labels={"y": ""},
-                title="Snapshot Timeline"
-            )
-
-            # Add connecting lines
-            fig.add_trace(
-                go.Scatter(
-                    x=snapshots_df.sort_values('timestamp')['timestamp'],
-                    y=[1] * len(snapshots_df),
-                    mode='lines',
-                    line=dict(color='lightblue', width=1),
-                    showlegend=False
-                )
-            )
-
-            # Improve layout
-            fig.update_layout(
-                height=300,
-                yaxis=dict(
-                    showticklabels=False,
-                    showgrid=False,
-                    zeroline=False,
-                    range=[0.5, 1.5]  # Fix y-axis range
-                ),
-                xaxis=dict(
-                    title="Time"
-                ),
-                hovermode="x unified",
-                margin=dict(l=20, r=20, t=40, b=20),
-            )
-
-            # Customize hover information
-            fig.update_traces(
-                hovertemplate="<b>Snapshot ID:</b> %{customdata}<br><b>Time:</b> %{x}<extra></extra>",
-                customdata=snapshots_df.sort_values('timestamp')['snapshot_id']
-            )
-
+        if len(snapshots_df) >= 2:
+            fig = build_timeline_figure(snapshots_df)
             st.plotly_chart(fig, use_container_width=True)
 
             # Display snapshot interval statistics
+            try:
+                intervals_df = calculate_snapshot_intervals(snapshots_tbl).to_pandas()
+            except Exception as e:
+                st.error(f"Error calculating snapshot intervals: {str(e)}")
+                intervals_df = pd.DataFrame()
+
             if not intervals_df.empty:
+                interval_seconds = intervals_df['interval_seconds'].to_numpy()
+                avg_hours = interval_seconds.mean() / 3600
+                min_hours = interval_seconds.min() / 3600
+                max_hours = interval_seconds.max() / 3600
+
                 interval_cols = st.columns(3)
 
                 with interval_cols[0]:
-                    avg_hours = intervals_df['interval_hours'].mean()
                     st.metric("Avg Interval", f"{avg_hours:.1f} hours")
 
                 with interval_cols[1]:
-                    min_hours = intervals_df['interval_hours'].min()
                     st.metric("Min Interval", f"{min_hours:.1f} hours")
 
                 with interval_cols[2]:
-                    max_hours = intervals_df['interval_hours'].max()
                     st.metric("Max Interval", f"{max_hours:.1f} hours")
 
-                # Show histogram of snapshot intervals
-                fig = px.histogram(
-                    intervals_df,
-                    x='interval_hours',
-                    nbins=min(10, len(intervals_df)),
-                    title="Distribution of Snapshot Intervals",
-                    labels={"interval_hours": "Interval (hours)"},
-                    color_discrete_sequence=['lightblue']
-                )
-
-                fig.update_layout(
-                    xaxis_title="Hours between snapshots",
-                    yaxis_title="Count",
-                    bargap=0.1,
-                    height=300
-                )
-
+                fig = build_interval_histogram(intervals_df['interval_hours'].to_numpy())
                 st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("Insufficient data to show snapshots timeline. Need multiple snapshots with timestamps.")
 
         # Recent Snapshots Table
-        expander = st.expander("View Recent Snapshots")
+        expander = st.expander("View Recent Snapshots", expanded=False)
         with expander:
             if not snapshots_df.empty:
-                if 'timestamp' in snapshots_df.columns:
-                    recent_snapshots = snapshots_df.sort_values('timestamp', ascending=False).head(5)
+                # Only build and send the table once the user asks for it
+                if st.checkbox("Load recent snapshots", key="_load_recent"):
+                    # Snapshots are loaded oldest first, so the most recent are at the end
+                    recent_snapshots = snapshots_df.tail(5).iloc[::-1]
                     st.dataframe(recent_snapshots, use_container_width=True)
-                else:
-                    st.dataframe(snapshots_df.head(5), use_container_width=True)
             else:
                 st.info("No snapshot data available.")
 
@@ -294,10 +386,3 @@ if metadata_path and analyze_button:
         st.error("Please check if the metadata path is correct and accessible.")
 else:
     st.info("Please provide an Iceberg table path and click 'Analyze Table' to begin analysis.")
-
-# Clean up temporary file if created
-if input_option == "Upload Metadata File" and 'temp_file' in locals():
-    try:
-        os.unlink(temp_file.name)
-    except:
-        pass